@@ -1,11 +1,54 @@
-from typing import Type
+from typing import Dict, FrozenSet, List, Optional, Tuple, Type
+from dataclasses import dataclass
+from datetime import datetime, timedelta, timezone
 import asyncio
+import random
+import time
 from mautrix.client import InternalEventType, MembershipEventDispatcher, SyncStream
-from mautrix.types import StateEvent, RoomID, UserID
+from mautrix.types import EventType, StateEvent, RoomID, UserID
+from mautrix.errors import MForbidden, MatrixConnectionError, MatrixRequestError
+from mautrix.util.async_db import Connection, UpgradeTable
 from mautrix.util.config import BaseProxyConfig, ConfigUpdateHelper
 from maubot import Plugin
 from maubot.handlers import event
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+upgrade_table = UpgradeTable()
+
+@upgrade_table.register(description="Initial revision")
+async def upgrade_v1(conn: Connection) -> None:
+    await conn.execute(
+        """CREATE TABLE dm_room (
+            user_id TEXT PRIMARY KEY,
+            room_id TEXT NOT NULL
+        )"""
+    )
+
+@dataclass(frozen=True, slots=True)
+class _Cfg:
+    """Immutable snapshot of the config, resolved to plain Python types.
+
+    Rebuilt at startup and on config reload so the per-event code never goes
+    through the YAML-backed proxy.
+    """
+    rooms: FrozenSet[RoomID]
+    whitelisted_homeservers: FrozenSet[str]
+    notification_room: Optional[RoomID]
+    message: str
+    notification_message: str
+    invite_message: str
+    non_whitelisted_message: str
+    authentik_enabled: bool
+    authentik_url: Optional[str] = None
+    authentik_headers: Optional[Dict[str, str]] = None
+    authentik_base_domain: Optional[str] = None
+    authentik_flow: Optional[str] = None
+    authentik_flow_slug: Optional[str] = None
+
 class Config(BaseProxyConfig):
     def do_update(self, helper: ConfigUpdateHelper) -> None:
         helper.copy("rooms")
@@ -15,34 +58,176 @@ class Config(BaseProxyConfig):
         helper.copy("invite_message")
         helper.copy("non_whitelisted_message")
         helper.copy("whitelisted_homeservers")
+        helper.copy("sso_details")
 
 class Greeter(Plugin):
+    ROOM_NAME_TTL = 3600  # seconds a cached room name stays valid without a state event
+    RECENT_JOIN_TTL = 300  # seconds within which a re-delivered join is treated as a duplicate
 
     async def start(self) -> None:
         await super().start()
         self.config.load_and_update()
+        self._rebuild_config_caches()
         self.client.add_dispatcher(MembershipEventDispatcher)
+        self._room_name_cache: Dict[RoomID, Tuple[float, str]] = {}
+        self._pending: Dict[RoomID, List[Tuple[StateEvent, Optional[asyncio.Task]]]] = {}
+        self._flush_tasks: Dict[RoomID, asyncio.Task] = {}
+        # Cap concurrent outbound API calls so a join flood can't burst enough
+        # requests to trip the homeserver's rate limiter (M_LIMIT_EXCEEDED).
+        self._api_sem = asyncio.Semaphore(8)
+        # Event handlers are registered before start() runs and can fire during
+        # the awaits below, so everything they touch must already exist.
+        self._recent_joins: Dict[Tuple[RoomID, UserID], float] = {}
+        self._joined_rooms: set = set()
+        self._dm_rooms: Dict[UserID, RoomID] = {
+            UserID(row["user_id"]): RoomID(row["room_id"])
+            for row in await self.database.fetch("SELECT user_id, room_id FROM dm_room")
+        }
+        self.log.debug(f"Loaded {len(self._dm_rooms)} cached DM rooms")
+        joined = await self.retry(self.client.get_joined_rooms)
+        # Update in place so membership events that landed mid-start are kept
+        self._joined_rooms.update(joined)
+        self.log.debug(f"Seeded joined-room cache with {len(self._joined_rooms)} rooms")
+        self._sweep_task = asyncio.create_task(self._sweep_recent_joins())
         self.log.info("Greeter plugin started")
         self.client.api.TIMEOUT = 300  # Set the timeout for API requests
 
+    async def stop(self) -> None:
+        self._sweep_task.cancel()
+        await super().stop()
+
+    async def _sweep_recent_joins(self) -> None:
+        while True:
+            await asyncio.sleep(self.RECENT_JOIN_TTL)
+            cutoff = time.monotonic() - self.RECENT_JOIN_TTL
+            for key in [k for k, ts in self._recent_joins.items() if ts < cutoff]:
+                del self._recent_joins[key]
+
+    def _rebuild_config_caches(self) -> None:
+        sso_details = self.config["sso_details"]
+        authentik = {}
+        if sso_details["API_URL"]:
+            # The Authentik endpoint, auth headers and link domain only change
+            # on config reload, so derive them once here instead of per invite.
+            authentik = dict(
+                authentik_url=f"{sso_details['API_URL']}/stages/invitation/invitations/",
+                authentik_headers={
+                    "Authorization": f"Bearer {sso_details['AUTHENTIK_API_TOKEN']}",
+                    "Content-Type": "application/json",
+                },
+                authentik_base_domain=sso_details["API_URL"].split("//")[1].split("/")[0],
+                authentik_flow=sso_details["FLOW_ID"],
+                authentik_flow_slug=sso_details["FLOW_SLUG"],
+            )
+        notification_room = self.config["notification_room"]
+        self._cfg = _Cfg(
+            rooms=frozenset(self.config["rooms"]),
+            whitelisted_homeservers=frozenset(self.config["whitelisted_homeservers"]),
+            notification_room=RoomID(notification_room) if notification_room else None,
+            message=self.config["message"],
+            notification_message=self.config["notification_message"],
+            invite_message=self.config["invite_message"],
+            non_whitelisted_message=self.config["non_whitelisted_message"],
+            authentik_enabled=bool(sso_details["API_URL"]),
+            **authentik,
+        )
+
+    def on_external_config_update(self) -> None:
+        super().on_external_config_update()
+        self._rebuild_config_caches()
+
+    @event.on(InternalEventType.JOIN)
+    async def track_own_join(self, evt: StateEvent) -> None:
+        if evt.state_key == self.client.mxid:
+            self._joined_rooms.add(evt.room_id)
+
+    def _handle_departure(self, evt: StateEvent) -> None:
+        if evt.state_key == self.client.mxid:
+            self._joined_rooms.discard(evt.room_id)
+            return
+        # A user who leaves during the greeting delay shouldn't be welcomed;
+        # drop their queued entry and cancel the in-flight invite so the rest
+        # of their greet flow never runs.
+        pending = self._pending.get(evt.room_id)
+        if pending:
+            for entry in pending:
+                if entry[0].sender == evt.state_key:
+                    if entry[1]:
+                        entry[1].cancel()
+                    pending.remove(entry)
+                    # This join never got greeted, so forget it for dedup
+                    # purposes: a genuine rejoin should be welcomed normally.
+                    self._recent_joins.pop((evt.room_id, evt.state_key), None)
+                    self.log.debug(f"Dropped pending greet for {evt.state_key}, they left {evt.room_id}")
+                    break
+
+    @event.on(InternalEventType.LEAVE)
+    async def track_leave(self, evt: StateEvent) -> None:
+        self._handle_departure(evt)
+
+    @event.on(InternalEventType.KICK)
+    async def track_kick(self, evt: StateEvent) -> None:
+        self._handle_departure(evt)
+
+    @event.on(InternalEventType.BAN)
+    async def track_ban(self, evt: StateEvent) -> None:
+        self._handle_departure(evt)
+
+    RETRY_BASE = 0.25  # seconds before the first retry
+    RETRY_CAP = 8  # upper bound on a single backoff sleep
+
+    @staticmethod
+    def _split_mxid(user_id: UserID) -> Tuple[str, str]:
+        # The sender is already validated by mautrix before the handler fires,
+        # so a plain split beats parse_user_id's regex on the hot path. The
+        # localpart can't contain ':', the server name can (host:port).
+        localpart, homeserver = user_id[1:].split(':', 1)
+        return localpart, homeserver
+
+    @staticmethod
+    def _is_retryable(e: Exception) -> bool:
+        if isinstance(e, (MatrixConnectionError, asyncio.TimeoutError)):
+            return True
+        if isinstance(e, MatrixRequestError):
+            # Rate limits and server errors are transient; other 4xx won't
+            # get better by asking again.
+            return e.http_status == 429 or e.http_status >= 500
+        return False
+
     async def retry(self, func, *args, retries=3, **kwargs):
         for i in range(retries):
             try:
-                return await func(*args, **kwargs)
+                # Hold the throttle only for the call itself, not the backoff sleep
+                async with self._api_sem:
+                    return await func(*args, **kwargs)
             except Exception as e:
-                if i < retries - 1:
-                    self.log.warning(f"Retry {i + 1}/{retries} for {func.__name__} due to {e}")
-                    await asyncio.sleep(2 ** i)  # Exponential backoff
+                if i < retries - 1 and self._is_retryable(e):
+                    # Capped exponential backoff with jitter so clients hitting a
+                    # shared outage don't all retry in lockstep
+                    delay = min(self.RETRY_CAP, self.RETRY_BASE * 2 ** i) * (0.5 + random.random())
+                    self.log.warning(f"Retry {i + 1}/{retries} for {func.__name__} in {delay:.2f}s due to {e}")
+                    await asyncio.sleep(delay)
                 else:
-                    self.log.error(f"Failed {func.__name__} after {retries} retries: {e}")
+                    self.log.error(f"Failed {func.__name__} after {i + 1} attempts: {e}")
                     raise e
 
+    async def get_room_name(self, room_id: RoomID) -> str:
+        """Return the room's display name, fetching at most once per TTL window."""
+        cached = self._room_name_cache.get(room_id)
+        if cached and time.monotonic() - cached[0] < self.ROOM_NAME_TTL:
+            return cached[1]
+        roomnamestate = await self.client.get_state_event(room_id, 'm.room.name')
+        roomname = roomnamestate.get('name', room_id)  # Use room_id if name is not available
+        self._room_name_cache[room_id] = (time.monotonic(), roomname)
+        return roomname
+
+    @event.on(EventType.ROOM_NAME)
+    async def track_room_name(self, evt: StateEvent) -> None:
+        self._room_name_cache[evt.room_id] = (time.monotonic(), evt.content.name or evt.room_id)
+
     async def send_if_member(self, room_id: RoomID, message: str) -> None:
         try:
-            self.log.debug(f"Checking if bot is a member of room {room_id}")
-            joined_rooms = await self.retry(self.client.get_joined_rooms)
-            self.log.debug(f"Joined rooms: {joined_rooms}")
-            if room_id in joined_rooms:
+            if room_id in self._joined_rooms:
                 self.log.debug(f"Bot is a member of room {room_id}, sending message")
                 await self.retry(self.client.send_notice, room_id, html=message)
             else:
@@ -50,12 +235,65 @@ class Greeter(Plugin):
         except Exception as e:
             self.log.error(f"Failed to send message to {room_id}: {e}")
 
+    async def create_invite(self, username: str) -> Optional[str]:
+        """Create a single-use Authentik invitation and return its pk, or None on failure."""
+        now = datetime.now(timezone.utc)
+        data = {
+            # The microsecond suffix keeps names unique when a join burst
+            # creates several invites within the same second.
+            "name": f"{username}-{now.strftime('%Y-%m-%dT%H-%M-%S')}-{now.microsecond:06d}",
+            "expires": (now + timedelta(hours=2)).isoformat(),
+            "fixed_data": {},
+            "single_use": True,
+            "flow": self._cfg.authentik_flow,
+        }
+        try:
+            self.log.debug(f"Creating Authentik invite for {username}")
+            # self.http is maubot's shared aiohttp session, so the event loop keeps
+            # serving other greets while the Authentik round-trip is in flight.
+            # With orjson available, encode to bytes ourselves: it's several
+            # times faster than stdlib json and aiohttp sends bytes as-is.
+            if orjson is not None:
+                req = self.http.post(self._cfg.authentik_url, headers=self._cfg.authentik_headers,
+                                     data=orjson.dumps(data))
+            else:
+                req = self.http.post(self._cfg.authentik_url, headers=self._cfg.authentik_headers,
+                                     json=data)
+            async with req as resp:
+                if resp.status == 403:
+                    self.log.error("Authentik API token lacks permission to create invites")
+                    return None
+                resp.raise_for_status()
+                body = orjson.loads(await resp.read()) if orjson is not None else await resp.json()
+                return body["pk"]
+        except Exception as e:
+            self.log.error(f"Failed to create invite for {username}: {e}")
+            return None
+
+    async def _create_dm_room(self, user_id: UserID) -> RoomID:
+        self.log.debug(f"Creating direct message room with user {user_id}")
+        room_id = await self.retry(self.client.create_room, invitees=[user_id], is_direct=True)
+        self.log.debug(f"Created direct message room ID: {room_id}")
+        self._dm_rooms[user_id] = room_id
+        await self.database.execute(
+            "INSERT INTO dm_room (user_id, room_id) VALUES ($1, $2) "
+            "ON CONFLICT (user_id) DO UPDATE SET room_id = excluded.room_id",
+            user_id, room_id,
+        )
+        return room_id
+
     async def send_direct_message(self, user_id: UserID, message: str) -> None:
         try:
-            self.log.debug(f"Creating direct message room with user {user_id}")
-            room_id = await self.retry(self.client.create_room, invitees=[user_id], is_direct=True)
-            self.log.debug(f"Created direct message room ID: {room_id}")
-            await self.retry(self.client.send_text, room_id, message)
+            room_id = self._dm_rooms.get(user_id)
+            if room_id is None:
+                room_id = await self._create_dm_room(user_id)
+            try:
+                await self.retry(self.client.send_text, room_id, message)
+            except MForbidden:
+                # The cached room is stale (user left / bot kicked): make a new one
+                self.log.debug(f"Cached DM room {room_id} rejected us, recreating")
+                room_id = await self._create_dm_room(user_id)
+                await self.retry(self.client.send_text, room_id, message)
             self.log.debug(f"Sent direct message to {user_id}")
         except Exception as e:
             self.log.error(f"Failed to send direct message to {user_id}: {e}")
@@ -63,47 +301,108 @@ class Greeter(Plugin):
     @event.on(InternalEventType.JOIN)
     async def greet(self, evt: StateEvent) -> None:
         self.log.debug(f"User {evt.sender} joined room {evt.room_id}")
-        if evt.room_id in self.config["rooms"]:
-            if evt.source & SyncStream.STATE:
-                self.log.debug("Ignoring state event")
-                return
+        if evt.room_id not in self._cfg.rooms:
+            return
+        if evt.source & SyncStream.STATE:
+            self.log.debug("Ignoring state event")
+            return
+        # Matrix can re-deliver the same join on reconnect/resync; welcome each
+        # (room, user) pair at most once per TTL window.
+        key = (evt.room_id, evt.sender)
+        now = time.monotonic()
+        last_seen = self._recent_joins.get(key)
+        if last_seen is not None and now - last_seen < self.RECENT_JOIN_TTL:
+            self.log.debug(f"Ignoring duplicate join of {evt.sender} to {evt.room_id}")
+            return
+        self._recent_joins[key] = now
+        # Kick off the Authentik invite now so its round-trip hides under the
+        # greeting delay instead of adding to it.
+        invite_task = None
+        nick, homeserver = self._split_mxid(evt.sender)
+        if self._cfg.authentik_enabled and homeserver in self._cfg.whitelisted_homeservers:
+            invite_task = asyncio.create_task(self.create_invite(nick))
+        # Coalesce joins arriving within the greeting delay into one batch per
+        # room: a join flood produces a single welcome notice and a single
+        # notification message instead of N of each.
+        self._pending.setdefault(evt.room_id, []).append((evt, invite_task))
+        if evt.room_id not in self._flush_tasks:
+            self._flush_tasks[evt.room_id] = asyncio.create_task(self._flush_joins(evt.room_id))
+
+    async def _flush_joins(self, room_id: RoomID) -> None:
+        cfg = self._cfg
+        # Start the room-name fetch now so its latency overlaps with the delay below
+        name_task = None
+        if cfg.notification_room:
+            name_task = asyncio.create_task(self.get_room_name(room_id))
+
+        self.log.debug("Waiting 10 seconds before sending the welcome messages")
+        try:
+            await asyncio.sleep(10)
+        finally:
+            self._flush_tasks.pop(room_id, None)
+        events = self._pending.pop(room_id, [])
+        if not events:
+            # Everyone left before the flush; don't leave the name fetch
+            # running (or its failure unretrieved) with nothing to send.
+            if name_task:
+                name_task.cancel()
+            return
+
+        roomname = await name_task if name_task else room_id
+        room_link = f'<a href="https://matrix.to/#/{room_id}">{roomname}</a>'
+
+        whitelisted_links = []
+        non_whitelisted_links = []
+        notification_lines = []
+        coros = []
+        for evt, invite_task in events:
+            nick, homeserver = self._split_mxid(evt.sender)
+            user_link = f'<a href="https://matrix.to/#/{evt.sender}">{nick}</a>'
+            whitelisted = homeserver in cfg.whitelisted_homeservers
+
+            # Include whether the user is from a whitelisted homeserver in the notification message
+            notification_lines.append(cfg.notification_message.format_map({
+                'user': user_link,
+                'room': room_link,
+                'homeserver_status': "whitelisted" if whitelisted else "non-whitelisted",
+            }))
+
+            if whitelisted:
+                whitelisted_links.append(user_link)
+                invite_message = cfg.invite_message.format_map({'user': nick})
+                # The invite task was started when the join arrived, so by now
+                # it has usually finished; this await just collects the result.
+                invite_pk = await invite_task if invite_task else None
+                if invite_pk:
+                    invite_link = (f"https://{cfg.authentik_base_domain}/if/flow/"
+                                   f"{cfg.authentik_flow_slug}/?itoken={invite_pk}")
+                    invite_message += f"\n\nHere is your single-use invite link (valid for 2 hours): {invite_link}"
+                self.log.debug(f"Formatted invite message: {invite_message}")
+                coros.append(self.send_direct_message(evt.sender, invite_message))
             else:
-                nick = self.client.parse_user_id(evt.sender)[0]
-                user_link = f'<a href="https://matrix.to/#/{evt.sender}">{nick}</a>'
-                room_link = f'<a href="https://matrix.to/#/{evt.room_id}">{evt.room_id}</a>'
-                homeserver = evt.sender.split(':')[1]
-
-                # Notify the notification room
-                if self.config["notification_room"]:
-                    self.log.debug(f"Sending notification to room {self.config['notification_room']}")
-                    roomnamestate = await self.client.get_state_event(evt.room_id, 'm.room.name')
-                    roomname = roomnamestate.get('name', evt.room_id)  # Use room_id if name is not available
-
-                    # Include whether the user is from a whitelisted homeserver in the notification message
-                    notification_message = self.config['notification_message'].format(
-                        user=user_link,
-                        room=room_link,
-                        homeserver_status=("whitelisted" if homeserver in self.config["whitelisted_homeservers"] else "non-whitelisted")
-                    )
-                    self.log.debug(f"Formatted notification message: {notification_message}")
-                    await self.send_if_member(RoomID(self.config["notification_room"]), notification_message)
-
-                self.log.debug("Waiting 10 seconds before sending the welcome message")
-                await asyncio.sleep(10)
-
-                if homeserver in self.config["whitelisted_homeservers"]:
-                    msg = self.config["message"].format(user=user_link)
-                    self.log.debug(f"Formatted welcome message for whitelisted user: {msg}")
-                    await self.send_if_member(evt.room_id, msg)
-
-                    invite_message = self.config["invite_message"].format(user=nick)
-                    self.log.debug(f"Formatted invite message: {invite_message}")
-                    await self.send_direct_message(evt.sender, invite_message)
-                else:
-                    msg = self.config["non_whitelisted_message"].format(user=user_link)
-                    self.log.debug(f"Formatted welcome message for non-whitelisted user: {msg}")
-                    await self.send_if_member(evt.room_id, msg)
+                non_whitelisted_links.append(user_link)
+
+        if cfg.notification_room:
+            self.log.debug(f"Sending notification to room {cfg.notification_room}")
+            coros.append(self.send_if_member(cfg.notification_room, "<br>".join(notification_lines)))
+        if whitelisted_links:
+            msg = cfg.message.format_map({'user': ", ".join(whitelisted_links)})
+            self.log.debug(f"Formatted welcome message for whitelisted users: {msg}")
+            coros.append(self.send_if_member(room_id, msg))
+        if non_whitelisted_links:
+            msg = cfg.non_whitelisted_message.format_map({'user': ", ".join(non_whitelisted_links)})
+            self.log.debug(f"Formatted welcome message for non-whitelisted users: {msg}")
+            coros.append(self.send_if_member(room_id, msg))
+
+        # The sends target independent rooms, so run them in parallel; each
+        # helper already logs its own failures, return_exceptions keeps one
+        # failure from cancelling the others.
+        await asyncio.gather(*coros, return_exceptions=True)
 
     @classmethod
     def get_config_class(cls) -> Type[BaseProxyConfig]:
-        return Config
\ No newline at end of file
+        return Config
+
+    @classmethod
+    def get_db_upgrade_table(cls) -> UpgradeTable:
+        return upgrade_table
\ No newline at end of file